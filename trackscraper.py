@@ -1,16 +1,122 @@
 import argparse
+import concurrent.futures
+import functools
+import json
 import os
-import re
+import queue
+import shutil
+import threading
 import unicodedata
 
 import music_tag
+import mutagen.mp3
+import mutagen.mp4
 import requests
-from bs4 import BeautifulSoup
+from lxml import etree
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 try:
     from tqdm import tqdm
 except ImportError:
-    tqdm = lambda sequence: (i for i in sequence)
+    tqdm = lambda sequence, **kwargs: (i for i in sequence)
+
+try:
+    from requests_cache import CachedSession
+except ImportError:
+    CachedSession = None
+
+# Shared session, so everything reuses pooled keep-alive connections.
+SESSION = requests.Session()
+_ADAPTER = HTTPAdapter(
+    pool_connections=50,
+    pool_maxsize=50,
+    max_retries=Retry(total=3, backoff_factor=0.3),
+)
+SESSION.mount("http://", _ADAPTER)
+SESSION.mount("https://", _ADAPTER)
+
+# Listing pages can go through an HTTP cache too, if asked for with
+# use_listing_cache() (but not audio, which shouldn't end up in SQLite).
+# Server cache headers are honoured, and nothing is kept more than 5 minutes.
+# It's off by default: the watcher wants fresh pages, and a cached session
+# reads each page whole, so it can't be parsed as it downloads.
+_listing_cache = False
+_listing_session = None
+_listing_session_lock = threading.Lock()
+
+
+def use_listing_cache():
+    """Fetch listing pages through requests-cache from here on."""
+    global _listing_cache
+    if CachedSession is None:
+        raise ImportError("The listing cache needs requests-cache installed")
+    _listing_cache = True
+
+
+def listing_session():
+    """
+    The session to fetch listing pages with: the shared one, or the cached one
+    (set up on first use, in the user's cache directory) if that's enabled.
+    """
+    global _listing_session
+    if not _listing_cache:
+        return SESSION
+    with _listing_session_lock:
+        if _listing_session is None:
+            _listing_session = CachedSession(
+                "weeklybeats_cache",
+                backend="sqlite",
+                use_cache_dir=True,
+                cache_control=True,
+                expire_after=300,
+            )
+            _listing_session.mount("http://", _ADAPTER)
+            _listing_session.mount("https://", _ADAPTER)
+        return _listing_session
+
+
+# WB serves its pages as UTF-8. Parsing bytes with this set skips any
+# detection, and doesn't trust requests' ISO-8859-1 default for text/html
+# without a charset.
+ENCODING = "utf-8"
+
+# Records what's already been downloaded/tagged in a destination directory.
+INDEX_FILENAME = ".wbindex.json"
+
+# mutagen file types for the formats WB serves, so we needn't sniff for them.
+_MUTAGEN_TYPES = {
+    ".mp3": mutagen.mp3.MP3,
+    ".m4a": mutagen.mp4.MP4,
+    ".mp4": mutagen.mp4.MP4,
+}
+
+
+@functools.lru_cache(maxsize=None)
+def _signature_xpath(key):
+    """
+    Compiles a (flattened) signature into an XPath, relative to a track tag,
+    for the tag at the end of the chain (with each earlier item its direct
+    parent). Cached, so scrapers sharing signatures share compiled XPaths.
+    """
+    steps = []
+    for name, attrs in key:
+        step = name
+        for attr, value in attrs:
+            if not value:
+                step += "[@{}]".format(attr)
+            elif isinstance(value, tuple):
+                # Multi-valued (class) attributes match as a whole list.
+                step += '[normalize-space(@{})="{}"]'.format(attr, " ".join(value))
+            else:
+                step += '[@{}="{}"]'.format(attr, value)
+        steps.append(step)
+    return etree.XPath(".//" + "/".join(steps))
+
+
+def _tag_text(tag):
+    """Default converter: just the tag's text."""
+    return tag.text
 
 
 class TrackListScraper:
@@ -21,8 +127,10 @@ class TrackListScraper:
     parse or cast the data to relevant formats.
     """
 
-    def __init__(self):
+    def __init__(self, session=None):
         self.tracks = []
+        # None means listing_session(), looked up when we actually scrape.
+        self.session = session
         # Key bits of data are identified by certain signatures of tags,
         #   some of which with certain attributes.
         self.signatures = {
@@ -33,65 +141,93 @@ class TrackListScraper:
             ),
         }
         self.converters = {}
+        self._compiled = None
 
     def scrape(self, url, params=None):
         """Convenience function to scrape tracks from a URL + query params"""
         before = len(self.tracks)
-        r = requests.get(url, params)
-        self.feed(r.text)
+        session = listing_session() if self.session is None else self.session
+        # Parse the page as it downloads. (Unless it's from the listing cache,
+        # which reads the whole body first, but saves the download on a hit.)
+        with session.get(url, params=params, stream=True) as r:
+            self._feed_chunks(r.iter_content(chunk_size=16384), ENCODING)
         return len(self.tracks) > before
 
-    def _signature_key_match(self, tag, key, verbose=False):
+    @staticmethod
+    def _signature_key(sig):
+        """
+        Flattens a signature into a hashable tuple,
+        ((name, ((attr, value), ...)), ...), with list values as tuples.
+        """
+        return tuple(
+            (
+                name,
+                tuple(
+                    (attr, tuple(value) if isinstance(value, list) else value)
+                    for attr, value in attrs.items()
+                ),
+            )
+            for name, attrs in sig
+        )
+
+    def _compiled_signatures(self):
         """
-        Checks a BeautifulSoup tag against a signature item (name, plus attrs).
+        (thing, XPath, converter) for each signature, built on first use
+        (subclasses add their signatures and converters after our __init__).
         """
-        if verbose:
-            print("checking for {}".format(key))
-        if tag.name != key[0]:
-            if verbose:
-                print("  mismatch name {} != {}".format(tag.name, key[0]))
-            return False
-        for attr in key[1]:
-            if not tag.has_attr(attr):
-                if verbose:
-                    print("  absent " + attr)
-                return False
-            value = key[1][attr]
-            if value and value != tag[attr]:
-                if verbose:
-                    print("  mismatch {} != {}".format(tag[attr], value))
-                return False
-        return True
-
-    def _signature_match_function(self, sig):
+        if self._compiled is None:
+            self._compiled = [
+                (
+                    thing,
+                    _signature_xpath(self._signature_key(sig)),
+                    self.converters.get(thing, _tag_text),
+                )
+                for thing, sig in self.signatures.items()
+            ]
+        return self._compiled
+
+    def feed(self, contents, encoding=None):
         """
-        Returns a function that checks a tag against the specified signature.
-        (name/attrs of tag itself, and looking back to any relevant parents)
+        Parse page contents for tracks. Pass raw bytes plus a known encoding
+        (e.g. ENCODING for WB pages) to skip encoding detection.
         """
+        self._feed_chunks((contents,), encoding)
 
-        def signature_match(tag):
-            if not self._signature_key_match(tag, sig[-1]):
-                return False
-            for parent, key in zip(tag.parents, sig[-2::-1]):
-                if not self._signature_key_match(parent, key):
-                    return False
-            return True
-
-        return signature_match
-
-    def feed(self, contents):
-        b = BeautifulSoup(contents, features="html.parser")
-        track_tags = b.find_all("div", class_=re.compile("^main-item"))
-        for track_tag in track_tags:
-            track = {}
-            # Find signatured things in track tag contents
-            for thing, sig in self.signatures.items():
-                result = track_tag.find_all(self._signature_match_function(sig))
-                if len(result) != 1:
-                    print("Bad '{}' signature: found {}?".format(thing, len(result)))
-                track[thing] = self.converters.get(thing, lambda t: t.string)(result[0])
-            # TODO: validate track info
-            self.tracks.append(track)
+    def _feed_chunks(self, chunks, encoding=None):
+        """
+        Parse page contents, arriving in chunks, for tracks. Each track tag is
+        handled (then emptied) as soon as it's closed, without waiting for
+        the rest of the page.
+        """
+        compiled = self._compiled_signatures()
+        parser = etree.HTMLPullParser(events=("end",), tag="div", encoding=encoding)
+        for chunk in chunks:
+            parser.feed(chunk)
+            self._read_track_tags(parser, compiled)
+        parser.close()
+        self._read_track_tags(parser, compiled)
+
+    def _read_track_tags(self, parser, compiled):
+        for _, tag in parser.read_events():
+            if (tag.get("class") or "").startswith("main-item"):
+                self._read_track_tag(tag, compiled)
+                tag.clear()
+
+    def _read_track_tag(self, track_tag, compiled):
+        track = {}
+        # Signatures can share an XPath (e.g. title and page),
+        # so only search the track tag once for each.
+        results = {}
+        # Find signatured things in track tag contents
+        for thing, xpath, convert in compiled:
+            result = results.get(xpath)
+            if result is None:
+                result = results[xpath] = xpath(track_tag)
+            if len(result) != 1:
+                print("Bad '{}' signature: found {}?".format(thing, len(result)))
+            track[thing] = convert(result[0])
+        # TODO: validate track info
+        self.tracks.append(track)
 
 
 class TrackLinkScraper(TrackListScraper):
@@ -99,8 +235,8 @@ class TrackLinkScraper(TrackListScraper):
     Pull the track download URL and the artist name too.
     """
 
-    def __init__(self):
-        super().__init__()
+    def __init__(self, session=None):
+        super().__init__(session)
         self.signatures.update(
             {
                 "url": (("div", {"class": ["player-play", "play-list"]}),),
@@ -120,10 +256,12 @@ class TrackLinkScraper(TrackListScraper):
         def extract_track_url(tag):
             # "onclick" attr looks like
             # "setPlaylistItem('https://weeklybeats.s3.amazonaws.com/music/2022/wangus_weeklybeats-2022_1_wheats-thics-[sic].m4a');..."
-            return tag.attrs["onclick"].split("'")[1]
+            onclick = tag.get("onclick")
+            start = onclick.index("'") + 1
+            return onclick[start : onclick.index("'", start)]
 
         def extract_page_url(tag):
-            return tag.attrs["href"]
+            return tag.get("href")
 
         self.converters.update(
             {
@@ -133,26 +271,80 @@ class TrackLinkScraper(TrackListScraper):
         )
 
 
+def parse_page(contents, encoding=None, scraper_class=TrackLinkScraper):
+    """
+    Parse one page's tracks with its own scraper, so pages can be parsed in
+    parallel. (lxml releases the GIL while parsing, so threads will do.)
+    """
+    # Past the last page of results (or on an error page) there are no track
+    # tags at all, which a plain byte search can tell us without parsing.
+    if b"main-item" not in contents:
+        return []
+    scraper = scraper_class()
+    scraper.feed(contents, encoding)
+    return scraper.tracks
+
+
 def scrape_week_tracks(week, year=2022):
     """
     Grab all the tracks for a specified week (probably spans multiple pages)
     """
-    scraper = TrackLinkScraper()
-    for i in range(1, 10):
-        if not scraper.scrape(
+
+    def scrape_page(i):
+        r = listing_session().get(
             "https://weeklybeats.com/music",
             params={"p": i, "o": "title", "s": "tag:week {} {}".format(week, year)},
+        )
+        return parse_page(r.content, ENCODING)
+
+    # Fetch and parse all the pages at once, then collect them in order
+    # until we run out.
+    pages = range(1, 10)
+    tracks = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(pages)) as ex:
+        for page_tracks in ex.map(scrape_page, pages):
+            if not page_tracks:
+                break
+            tracks.extend(page_tracks)
+    return tracks
+
+
+class _DescriptionTarget:
+    """
+    lxml parser target that picks out a track page's og:description,
+    without building a tree for the rest of the page.
+    """
+
+    def __init__(self):
+        self.description = None
+
+    def start(self, tag, attrib):
+        if (
+            self.description is None
+            and tag == "meta"
+            and attrib.get("property") == "og:description"
         ):
-            break
-    return scraper.tracks
+            self.description = attrib["content"]
 
+    def close(self):
+        return self.description
 
+
+@functools.lru_cache(maxsize=4096)
 def get_track_description(page_url):
-    r = requests.get(page_url)
-    b = BeautifulSoup(r.text, features="html.parser")
-    description = b.head.find_all("meta", property="og:description")[0].attrs["content"]
+    r = SESSION.get(page_url)
+    # The description is in <head>, so don't bother tokenizing the body
+    # (every tag of which would otherwise get its attrs built for start()).
+    contents = r.content
+    head_end = contents.find(b"</head>")
+    if head_end != -1:
+        contents = contents[:head_end]
+    parser = etree.HTMLParser(target=_DescriptionTarget(), encoding=ENCODING)
+    description = etree.fromstring(contents, parser)
     # Newline and unicode compatibility normalization
-    description = "\n".join(unicodedata.normalize("NFKD", description).splitlines())
+    description = description.replace("\r\n", "\n").replace("\r", "\n")
+    if not description.isascii():
+        description = unicodedata.normalize("NFKC", description)
     return description
 
 
@@ -160,27 +352,62 @@ def scrape_track_descriptions(tracks):
     """
     Grab all the track descriptions.
     """
-    for track in tqdm(tracks):
-        track["description"] = get_track_description(track["page"])
+    with concurrent.futures.ThreadPoolExecutor(max_workers=32) as ex:
+        futures = {
+            ex.submit(get_track_description, track["page"]): track for track in tracks
+        }
+        # Take them as they finish, so one slow page doesn't stall the others.
+        for future in tqdm(
+            concurrent.futures.as_completed(futures), total=len(futures)
+        ):
+            futures[future]["description"] = future.result()
 
 
-def download_track(track, destination, album=None, force_download=False):
+def _tags_up_to_date(f, track, album):
     """
-    Download a particular track and update metadata with title/artist/album.
+    Whether a loaded music_tag file already has all the metadata we'd write,
+    so we can skip rewriting it. May zero its track numbers in memory.
     """
-    file_path = os.path.join(destination, track["url"].split("/")[-1])
-    if not os.path.exists(file_path) or force_download:
-        r = requests.get(track["url"])
-        with open(file_path, "wb+") as g:
-            g.write(r.content)
-    f = music_tag.load_file(file_path)
+    expected = {
+        "title": [track["title"]],
+        "artist": [track["artist"]],
+        "compilation": [True],
+        "albumartist": ["Various Artists"],
+        "album": [] if album is None else [album],
+    }
+    if any(f[tag].values != values for tag, values in expected.items()):
+        return False
+    # What zeroed track numbers read back as depends on the format, so zero
+    # them here and see if that changed anything. (The file isn't saved if
+    # it's up to date, and they get zeroed anyway if it isn't.)
+    track_numbers = ("tracknumber", "totaltracks")
+    before = [f[tag].values for tag in track_numbers]
+    for tag in track_numbers:
+        f[tag] = 0
+    if [f[tag].values for tag in track_numbers] != before:
+        return False
+    return "lyrics" in f
+
+
+def tag_track(track, file_path, album=None):
+    """
+    Update a downloaded track's metadata with title/artist/album.
+    """
+    mutagen_type = _MUTAGEN_TYPES.get(os.path.splitext(file_path)[1].lower())
+    f = music_tag.load_file(
+        file_path if mutagen_type is None else mutagen_type(file_path)
+    )
+    if _tags_up_to_date(f, track, album):
+        return
     f["title"] = track["title"]
     f["artist"] = track["artist"]
     f["compilation"] = True
     f["albumartist"] = "Various Artists"
     # Use the lyrics field to include the original description.
     if "lyrics" not in f:
-        f["lyrics"] = get_track_description(track["page"])
+        if "description" not in track:
+            track["description"] = get_track_description(track["page"])
+        f["lyrics"] = track["description"]
     for tag in ("tracknumber", "totaltracks"):
         # I'm having trouble getting music-tag to unset track numbers on some files. This is OK?
         f[tag] = 0
@@ -190,9 +417,172 @@ def download_track(track, destination, album=None, force_download=False):
     f.save()
 
 
+def _index_entry(file_path, track, album):
+    """
+    What the download index records for a file: its size/mtime on disk,
+    plus the metadata we tagged it with. None if the file doesn't exist.
+    """
+    try:
+        st = os.stat(file_path)
+    except FileNotFoundError:
+        return None
+    return {
+        "size": st.st_size,
+        "mtime": st.st_mtime_ns,
+        "tags": [track["title"], track["artist"], album],
+    }
+
+
+def load_index(destination):
+    """
+    Load a directory's download index (or empty if it doesn't exist yet).
+    It's only a cache, so an unreadable one is treated as empty too.
+    """
+    path = os.path.join(destination, INDEX_FILENAME)
+    if not os.path.isfile(path):
+        return {}
+    try:
+        with open(path) as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return index if isinstance(index, dict) else {}
+
+
+def save_index(index, destination):
+    """
+    Save a directory's download index.
+    Written to a temporary file and swapped in, so a crash can't corrupt it.
+    """
+    path = os.path.join(destination, INDEX_FILENAME)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as g:
+        json.dump(index, g)
+    os.replace(tmp_path, path)
+
+
+def _track_path(track, destination):
+    return os.path.join(destination, track["url"].split("/")[-1])
+
+
+def _indexed(index, file_path, track, album):
+    """Whether the download index says this file is already done."""
+    file_name = os.path.basename(file_path)
+    return file_name in index and index[file_name] == _index_entry(
+        file_path, track, album
+    )
+
+
+def _download_part(url, part_path, resume_from=None):
+    """
+    Stream a URL to a .part file, resuming from the given size if any.
+    Returns False if the .part file can't be resumed and should be discarded.
+    """
+    headers = {}
+    if resume_from is not None:
+        headers["Range"] = "bytes={}-".format(resume_from)
+    with SESSION.get(url, headers=headers, stream=True) as r:
+        # 416 says the range starts past the end, which only means the .part
+        # is already complete if the file is exactly as big as the .part.
+        if r.status_code == 416 and resume_from is not None:
+            return r.headers.get("Content-Range") == "bytes */{}".format(resume_from)
+        r.raise_for_status()
+        r.raw.decode_content = True
+        # Only append if the server honoured the range.
+        with open(part_path, "ab" if r.status_code == 206 else "wb") as g:
+            shutil.copyfileobj(r.raw, g, length=1 << 20)
+    return True
+
+
+def fetch_track(track, destination, force_download=False):
+    """
+    Download a particular track (unless we already have it).
+    Returns the path of the downloaded file.
+    """
+    file_path = _track_path(track, destination)
+    if not os.path.exists(file_path) or force_download:
+        # Download to a .part file (resuming any partial one) and stream it
+        # straight to disk, then move it into place once complete.
+        part_path = file_path + ".part"
+        resume_from = None
+        if os.path.exists(part_path) and not force_download:
+            resume_from = os.path.getsize(part_path)
+        if not _download_part(track["url"], part_path, resume_from):
+            # The .part doesn't match what the server has, so start over.
+            os.remove(part_path)
+            _download_part(track["url"], part_path)
+        os.replace(part_path, file_path)
+    return file_path
+
+
+def download_track(track, destination, album=None, force_download=False):
+    """
+    Download a particular track and update metadata with title/artist/album.
+    """
+    tag_track(track, fetch_track(track, destination, force_download), album)
+
+
 def download_tracks(tracks, destination, album=None, force_download=False):
-    for track in tqdm(tracks):
-        download_track(track, destination, album, force_download)
+    """
+    Download tracks and update their metadata, skipping any the destination's
+    download index says are already done. Downloads run on their own pool and
+    hand each finished file off to a smaller tagging pool, so tagging never
+    holds up the next download.
+    """
+    # The same track can turn up twice (say, if it moves between listing
+    # pages while they're fetched), and two downloads of the same file would
+    # trample each other's .part file. So only take the first of each.
+    unique = {}
+    for track in tracks:
+        unique.setdefault(_track_path(track, destination), track)
+    tracks = list(unique.values())
+    index = load_index(destination)
+    if not force_download:
+        tracks = [
+            track
+            for track in tracks
+            if not _indexed(index, _track_path(track, destination), track, album)
+        ]
+    # New files will all need their descriptions for the lyrics, so fetch
+    # those together up front. Anything already on disk may well have them,
+    # and tag_track fetches lazily if not.
+    scrape_track_descriptions(
+        [
+            track
+            for track in tracks
+            if "description" not in track
+            and (force_download or not os.path.exists(_track_path(track, destination)))
+        ]
+    )
+    tagged = queue.Queue()
+
+    def tag_fetched(track, fetched):
+        file_path = fetched.result()
+        tag_track(track, file_path, album)
+        index[os.path.basename(file_path)] = _index_entry(file_path, track, album)
+
+    taggers = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+    fetchers = concurrent.futures.ThreadPoolExecutor(max_workers=16)
+
+    def hand_off(track, fetched):
+        taggers.submit(tag_fetched, track, fetched).add_done_callback(tagged.put)
+
+    # If anything fails, drop whatever's still queued rather than finishing
+    # every download before the error gets raised.
+    cancel = True
+    try:
+        for track in tracks:
+            fetched = fetchers.submit(fetch_track, track, destination, force_download)
+            fetched.add_done_callback(functools.partial(hand_off, track))
+        # Wait on each track's tagging to surface any exceptions.
+        for _ in tqdm(range(len(tracks))):
+            tagged.get().result()
+        cancel = False
+    finally:
+        # Fetchers first, as their callbacks still hand off to the taggers.
+        fetchers.shutdown(cancel_futures=cancel)
+        taggers.shutdown(cancel_futures=cancel)
+        save_index(index, destination)
 
 
 if __name__ == "__main__":
@@ -213,8 +603,19 @@ if __name__ == "__main__":
         action="store_true",
         help="Download all tracks (normally we skip already-downloaded)",
     )
+    parser.add_argument(
+        "-c",
+        "--cache",
+        action="store_true",
+        help="Cache track listings for a few minutes (needs requests-cache)",
+    )
     parser.add_argument("destination", help="Destination directory.")
     args = parser.parse_args()
+    if args.cache:
+        try:
+            use_listing_cache()
+        except ImportError as e:
+            parser.error(str(e))
 
     print("Scraping tracks...")
     tracks = scrape_week_tracks(args.week, args.year)
@@ -1,3 +1,4 @@
+import hashlib
 import json
 import os
 import sys
@@ -10,8 +11,8 @@ class WeekCommentsScraper(trackscraper.TrackListScraper):
     Additionally parse the week number and the current comment count.
     """
 
-    def __init__(self):
-        super().__init__()
+    def __init__(self, session=None):
+        super().__init__(session)
         self.signatures.update(
             {
                 "week": (
@@ -26,32 +27,71 @@ class WeekCommentsScraper(trackscraper.TrackListScraper):
         )
         self.converters.update(
             {
-                "week": lambda t: int(t.string.split()[1]),
-                "comments": lambda t: int(t.string),
+                "week": lambda t: int(t.text.split()[1]),
+                "comments": lambda t: int(t.text),
             }
         )
 
 
-def fetch_tracks(username="wangus"):
-    """Fetch a user's track listing"""
+def fetch_tracks(username="wangus", cache=None):
+    """
+    Fetch a user's track listing.
+    Given a cache dict (HTTP validators and a content hash from the last
+    fetch), returns None if the page hasn't changed since, otherwise parses
+    it and updates the cache.
+    """
     # TODO: does this paginate eventually?
     w = WeekCommentsScraper()
-    w.scrape("https://weeklybeats.com/" + username)
+    if cache is None:
+        w.scrape("https://weeklybeats.com/" + username)
+        return w.tracks
+    headers = {}
+    if "etag" in cache:
+        headers["If-None-Match"] = cache["etag"]
+    if "last_modified" in cache:
+        headers["If-Modified-Since"] = cache["last_modified"]
+    session = trackscraper.listing_session() if w.session is None else w.session
+    r = session.get("https://weeklybeats.com/" + username, headers=headers)
+    if r.status_code == 304:
+        return None
+    r.raise_for_status()
+    # Servers don't always send validators, so also skip re-parsing
+    # an identical page.
+    digest = hashlib.blake2b(r.content, digest_size=16).hexdigest()
+    if digest == cache.get("hash"):
+        return None
+    cache.clear()
+    cache["hash"] = digest
+    if "ETag" in r.headers:
+        cache["etag"] = r.headers["ETag"]
+    if "Last-Modified" in r.headers:
+        cache["last_modified"] = r.headers["Last-Modified"]
+    w.feed(r.content, trackscraper.ENCODING)
     return w.tracks
 
 
 def save_record(tracks, path):
-    """Save a comment count record to a file."""
-    with open(path, "w+") as g:
-        json.dump(tracks, g)
+    """
+    Save a comment count record ({week: comments}) to a file.
+    Written to a temporary file and swapped in, so a crash can't corrupt it.
+    """
+    record = {track["week"]: track["comments"] for track in tracks}
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as g:
+        json.dump(record, g)
+    os.replace(tmp_path, path)
 
 
 def load_record(path):
     """Load a comment count record from a file (or empty if file doesn't exist yet)"""
     if not os.path.isfile(path):
-        return []
+        return {}
     with open(path) as f:
-        return json.load(f)
+        record = json.load(f)
+    # Older records are a list of the tracks themselves.
+    if isinstance(record, list):
+        return {i["week"]: i["comments"] for i in record}
+    return {int(week): comments for week, comments in record.items()}
 
 
 def check_new_comments(tracks, record):
@@ -60,17 +100,13 @@ def check_new_comments(tracks, record):
     Ignores previously unrecorded tracks
     """
     new_comments = {}
-
-    def week_indexed(a):
-        return {i["week"]: i for i in a}
-
-    tracks, record = map(week_indexed, (tracks, record))
-    for week in tracks:
-        if week not in record:
+    for track in tracks:
+        recorded = record.get(track["week"])
+        if recorded is None:
             continue
-        new_comment_count = tracks[week]["comments"] - record[week]["comments"]
+        new_comment_count = track["comments"] - recorded
         if new_comment_count != 0:
-            new_comments[week] = new_comment_count
+            new_comments[track["week"]] = new_comment_count
     return new_comments
 
 
@@ -80,10 +116,22 @@ def fetch_new_comments(record_path, username="wangus"):
     assess which tracks have new comments,
     and update the record.
     """
-    tracks = fetch_tracks()
+    # The cache describes the page the record was made from,
+    # so it's only any use if the record is still there.
+    cache_path = record_path + ".cache"
+    cache = {}
+    if os.path.isfile(record_path) and os.path.isfile(cache_path):
+        with open(cache_path) as f:
+            cache = json.load(f)
+    tracks = fetch_tracks(username, cache)
+    if tracks is None:
+        # Unchanged since the record was saved.
+        return {}
     record = load_record(record_path)
     new_comments = check_new_comments(tracks, record)
     save_record(tracks, record_path)
+    with open(cache_path, "w+") as g:
+        json.dump(cache, g)
     return new_comments
 
 